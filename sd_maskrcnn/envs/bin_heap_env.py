@@ -23,14 +23,68 @@ Author: Mike Danielczuk
 
 import numpy as np
 import gym
+import multiprocessing as mp
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 
 from autolab_core import Logger
 from pyrender import (Scene, IntrinsicsCamera, Mesh, DirectionalLight, Viewer,
                       MetallicRoughnessMaterial, Node, OffscreenRenderer, RenderFlags)
 
+from .constants import MESH_CACHE_SIZE
 from .physics_engine import PybulletPhysicsEngine
 from .state_spaces import HeapAndCameraStateSpace
 
+# flips the y and z axes of a camera pose from the sampled frame to the OpenGL frame
+_GL_CAMERA_FLIP = np.array([1.0, -1.0, -1.0, 1.0])
+
+def _compute_raymond_matrices():
+    """ Computes the poses of the three Raymond lights. """
+    thetas = np.pi * np.array([1.0 / 6.0, 1.0 / 6.0, 1.0 / 6.0])
+    phis = np.pi * np.array([0.0, 2.0 / 3.0, 4.0 / 3.0])
+
+    matrices = []
+
+    for phi, theta in zip(phis, thetas):
+        xp = np.sin(theta) * np.cos(phi)
+        yp = np.sin(theta) * np.sin(phi)
+        zp = np.cos(theta)
+
+        z = np.array([xp, yp, zp])
+        z = z / np.linalg.norm(z)
+        x = np.array([-z[1], z[0], 0.0])
+        if np.linalg.norm(x) == 0:
+            x = np.array([1.0, 0.0, 0.0])
+        x = x / np.linalg.norm(x)
+        y = np.cross(z, x)
+
+        matrix = np.eye(4)
+        matrix[:3,:3] = np.c_[x,y,z]
+        matrices.append(matrix)
+
+    return matrices
+
+_RAYMOND_MATRICES = _compute_raymond_matrices()
+
+# state space owned by a prefetch worker process, kept across samples so that
+# its samplers (including the per-space gym RNGs) keep advancing
+_worker_state_space = None
+
+def _init_prefetch_worker(state_space):
+    global _worker_state_space
+    _worker_state_space = state_space
+
+    # reseed the per-space RNGs so the worker does not replay the parent's next draws
+    heap_space = state_space.heap
+    for space in [heap_space.heap_center_space, heap_space.obj_planar_pose_space,
+                  heap_space.obj_orientation_space]:
+        space.seed()
+
+def _sample_prefetch_state():
+    return _worker_state_space.sample()
+
 class BinHeapEnv(gym.Env):
     """ OpenAI Gym-style environment for creating object heaps in a bin. """
 
@@ -41,9 +95,21 @@ class BinHeapEnv(gym.Env):
         # read subconfigs
         self._state_space_config = self._config['state_space']
 
+        # set up logger
+        self._logger = Logger.get_logger(self.__class__.__name__)
+
         # initialize class variables
         self._state = None
         self._scene = None
+        self._renderer = None
+        self._camera_node = None
+        self._material = None
+        self._mesh_cache = OrderedDict()
+        self._node_by_name = {}
+        self._workspace_nodes = []
+        self._obj_nodes = []
+        self._executor = None
+        self._next_state = None
         self._physics_engine = PybulletPhysicsEngine(urdf_cache_dir=config['urdf_cache_dir'], debug=config['debug'])
         self._state_space = HeapAndCameraStateSpace(self._physics_engine, self._state_space_config)
 
@@ -81,7 +147,18 @@ class BinHeapEnv(gym.Env):
 
     def _reset_state_space(self):
         """ Sample a new static and dynamic state. """
-        state = self._state_space.sample()
+        if self._next_state is not None:
+            next_state = self._next_state
+            self._next_state = None
+            state = next_state.result()
+
+            # a worker whose samplers restart from the same state would repeat heaps
+            if self._state is not None and np.allclose(state.heap.metadata['heap_center'],
+                                                       self._state.metadata['heap_center']):
+                self._logger.warning('Prefetched heap has the same center as the previous heap, '
+                                     'the prefetch worker may be reusing its random state')
+        else:
+            state = self._state_space.sample()
         self._state = state.heap
         self._camera = state.camera
     
@@ -89,79 +166,113 @@ class BinHeapEnv(gym.Env):
         # update camera
         camera = IntrinsicsCamera(self.camera.intrinsics.fx, self.camera.intrinsics.fy, 
                                   self.camera.intrinsics.cx, self.camera.intrinsics.cy)
-        cn = next(iter(self._scene.get_nodes(name=self.camera.frame)))
+        cn = self._camera_node
         cn.camera = camera
-        pose_m = self.camera.pose.matrix.copy()
-        pose_m[:,1:3] *= -1.0
-        cn.matrix = pose_m
+        cn.matrix = self.camera.pose.matrix * _GL_CAMERA_FLIP
         self._scene.main_camera_node = cn
 
-        # update workspace
-        for obj_key in self.state.workspace_keys:
-            next(iter(self._scene.get_nodes(name=obj_key))).matrix = self.state[obj_key].pose.matrix
-
-        # update object
-        for obj_key in self.state.obj_keys:
-            next(iter(self._scene.get_nodes(name=obj_key))).matrix = self.state[obj_key].pose.matrix
+        # update workspace and objects
+        for node, obj_state in zip(chain(self._workspace_nodes, self._obj_nodes),
+                                   chain(self.state.workspace_states, self.state.obj_states)):
+            node.matrix = obj_state.pose.matrix
 
     def _reset_scene(self, scale_factor=1.0):
-        """ Resets the scene.
+        """ Resets the scene. The camera, lights and the meshes of any keys
+        still in the state are kept; only objects that changed are swapped.
 
         Parameters
         ----------
         scale_factor : float
             optional scale factor to apply to the image dimensions
         """
-        # delete scene
-        if self._scene is not None:
-            self._scene.clear()
-            del self._scene
-
         # create scene
-        scene = Scene()
+        if self._scene is None:
+            scene = Scene()
+
+            # setup camera
+            camera = IntrinsicsCamera(self.camera.intrinsics.fx, self.camera.intrinsics.fy, 
+                                      self.camera.intrinsics.cx, self.camera.intrinsics.cy)
+            pose_m = self.camera.pose.matrix * _GL_CAMERA_FLIP
+            self._camera_node = scene.add(camera, pose=pose_m, name=self.camera.frame)
+            scene.main_camera_node = self._camera_node
+
+            self._material = MetallicRoughnessMaterial(
+                baseColorFactor=np.array([1, 1, 1, 1.0]),
+                metallicFactor=0.2,
+                roughnessFactor=0.8
+            )
 
-        # setup camera
-        camera = IntrinsicsCamera(self.camera.intrinsics.fx, self.camera.intrinsics.fy, 
-                                  self.camera.intrinsics.cx, self.camera.intrinsics.cy)
-        pose_m = self.camera.pose.matrix.copy()
-        pose_m[:,1:3] *= -1.0
-        scene.add(camera, pose=pose_m, name=self.camera.frame)
-        scene.main_camera_node = next(iter(scene.get_nodes(name=self.camera.frame)))
-
-        material = MetallicRoughnessMaterial(
-            baseColorFactor=np.array([1, 1, 1, 1.0]),
-            metallicFactor=0.2,
-            roughnessFactor=0.8
-        )
-
-        # add workspace objects
-        for obj_key in self.state.workspace_keys:
-            obj_state = self.state[obj_key]
-            obj_mesh = Mesh.from_trimesh(obj_state.mesh, material=material)
-            T_obj_world = obj_state.pose.matrix
-            scene.add(obj_mesh, pose=T_obj_world, name=obj_key)
-
-        # add scene objects
-        for obj_key in self.state.obj_keys:
-            obj_state = self.state[obj_key]
-            obj_mesh = Mesh.from_trimesh(obj_state.mesh, material=material)
-            T_obj_world = obj_state.pose.matrix
-            scene.add(obj_mesh, pose=T_obj_world, name=obj_key)
-
-        # add light (for color rendering)
-        light = DirectionalLight(color=np.ones(3), intensity=1.0)
-        scene.add(light, pose=np.eye(4))
-        ray_light_nodes = self._create_raymond_lights()
-        [scene.add_node(rln) for rln in ray_light_nodes]
-
-        self._scene = scene
+            # add light (for color rendering)
+            light = DirectionalLight(color=np.ones(3), intensity=1.0)
+            scene.add(light, pose=np.eye(4))
+            ray_light_nodes = self._create_raymond_lights()
+            [scene.add_node(rln) for rln in ray_light_nodes]
+
+            self._scene = scene
+
+        # add workspace and scene objects that are not already in the scene
+        node_by_name = {}
+        try:
+            for obj_state in chain(self.state.workspace_states, self.state.obj_states):
+                node = self._node_by_name.get(obj_state.key)
+                if node is None:
+                    obj_mesh = self._get_mesh(obj_state)
+                    T_obj_world = obj_state.pose.matrix
+                    node = self._scene.add(obj_mesh, pose=T_obj_world, name=obj_state.key)
+                node_by_name[obj_state.key] = node
+        except Exception:
+            # remove the nodes added so far so the scene still matches the tracked nodes
+            for key, node in node_by_name.items():
+                if key not in self._node_by_name:
+                    self._scene.remove_node(node)
+            raise
+
+        # remove objects that left the state
+        for key, node in self._node_by_name.items():
+            if key not in node_by_name:
+                self._scene.remove_node(node)
+
+        self._node_by_name = node_by_name
+        self._workspace_nodes = [node_by_name[k] for k in self.state.workspace_keys]
+        self._obj_nodes = [node_by_name[k] for k in self.state.obj_keys]
+
+        self._update_scene()
+        self._reset_renderer()
+
+    def _get_mesh(self, obj_state):
+        """ Returns the pyrender mesh for an object state, converting its trimesh only
+        if the key is not among the most recently used meshes. Keys always refer to
+        the same mesh file, so cached meshes stay valid across resets.
+        """
+        obj_mesh = self._mesh_cache.pop(obj_state.key, None)
+        if obj_mesh is None:
+            obj_mesh = Mesh.from_trimesh(obj_state.mesh, material=self._material)
+        self._mesh_cache[obj_state.key] = obj_mesh
+        if len(self._mesh_cache) > MESH_CACHE_SIZE:
+            self._mesh_cache.popitem(last=False)
+        return obj_mesh
+
+    def _delete_renderer(self):
+        """ Deletes the offscreen renderer, unbinding all meshes from its context. """
+        if self._renderer is not None:
+            self._renderer.delete()
+            self._renderer = None
+
+    def _reset_renderer(self):
+        """ Creates the offscreen renderer, or resizes it to match the current camera. """
+        if self._renderer is None:
+            self._renderer = OffscreenRenderer(self.camera.width, self.camera.height)
+        else:
+            self._renderer.viewport_width = self.camera.width
+            self._renderer.viewport_height = self.camera.height
 
     def reset_camera(self):
         """ Resets only the camera.
         Useful for generating image data for multiple camera views
         """
         self._camera = self.state_space.camera.sample()
-        self._update_scene()     
+        self._update_scene()
+        self._reset_renderer()
 
     def reset(self):
         """ Reset the environment. """
@@ -172,81 +283,101 @@ class BinHeapEnv(gym.Env):
         # reset scene
         self._reset_scene()
 
+    def prefetch_state(self):
+        """ Start sampling the next state in a background process.
+        The next call to reset() uses this state. A process is used rather than a
+        thread because pybullet holds the GIL while it simulates. The worker is
+        spawned so it does not inherit the OpenGL context, and it receives one copy
+        of the state space when it starts, which it keeps for every later sample.
+        Changes made to this env's state space after the first prefetch are
+        therefore not seen by the worker.
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn'),
+                                                 initializer=_init_prefetch_worker,
+                                                 initargs=(self._state_space,))
+        if self._next_state is None:
+            self._next_state = self._executor.submit(_sample_prefetch_state)
+
+    def close(self):
+        """ Release the environment's resources. Waits for any prefetched state
+        to finish sampling, shuts down the prefetch worker, and deletes the
+        offscreen renderer and its OpenGL context.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._next_state = None
+        self._delete_renderer()
+
     def view_3d_scene(self):
         """ Render the scene in a 3D viewer.
         """
         if self.state is None or self.camera is None:
             raise ValueError('Cannot render 3D scene before state is set! You can set the state with the reset() function')
 
-        Viewer(self.scene, use_raymond_lighting=True)
+        # meshes can only be bound to one renderer, so hand them to the viewer
+        self._delete_renderer()
+        try:
+            Viewer(self.scene, use_raymond_lighting=True)
+        finally:
+            self._reset_renderer()
 
     def render_camera_image(self, color=True):
         """ Render the camera image for the current scene. """
-        renderer = OffscreenRenderer(self.camera.width, self.camera.height)
+        if self._renderer is None:
+            raise ValueError('Cannot render images without a renderer! Call reset() first, and do not render after close()')
+
         flags = RenderFlags.NONE if color else RenderFlags.DEPTH_ONLY
-        image = renderer.render(self._scene, flags=flags)
-        renderer.delete()
-        return image
+        return self._renderer.render(self._scene, flags=flags)
     
     def render_segmentation_images(self):
         """Renders segmentation masks (modal and amodal) for each object in the state.
         """
+        if self._renderer is None:
+            raise ValueError('Cannot render images without a renderer! Call reset() first, and do not render after close()')
 
-        full_depth = self.render_camera_image(color=False)
-        modal_data = np.zeros((full_depth.shape[0], full_depth.shape[1], len(self.obj_keys)), dtype=np.uint8)
-        amodal_data = np.zeros((full_depth.shape[0], full_depth.shape[1], len(self.obj_keys)), dtype=np.uint8)
-        renderer = OffscreenRenderer(self.camera.width, self.camera.height)
-        flags = RenderFlags.DEPTH_ONLY
+        obj_mesh_nodes = self._obj_nodes
 
-        # Hide all meshes
-        obj_mesh_nodes = [next(iter(self._scene.get_nodes(name=k))) for k in self.obj_keys]
-        for mn in self._scene.mesh_nodes:
-            mn.mesh.is_visible = False
+        # Modal masks come from a single instance id pass over the full scene
+        modal_ids = self._render_instance_ids(obj_mesh_nodes)
+        obj_ids = np.arange(1, len(obj_mesh_nodes) + 1)
+        modal_data = np.iinfo(np.uint8).max * (modal_ids[:,:,None] == obj_ids).astype(np.uint8)
+
+        # Amodal masks need one pass per object; a segmentation pass only draws
+        # the nodes in seg_node_map, so no mesh visibility has to be toggled
+        amodal_data = np.zeros_like(modal_data)
+        flags = RenderFlags.SEG
+        color = np.full(3, np.iinfo(np.uint8).max)
 
         for i, node in enumerate(obj_mesh_nodes):
-            node.mesh.is_visible = True
+            _, depth = self._renderer.render(self._scene, flags=flags, seg_node_map={node: color})
+            amodal_data[depth > 0.0,i] = np.iinfo(np.uint8).max
 
-            depth = renderer.render(self._scene, flags=flags)
-            amodal_mask = depth > 0.0
-            modal_mask = np.logical_and(
-                (np.abs(depth - full_depth) < 1e-6), full_depth > 0.0
-            )
-            amodal_data[amodal_mask,i] = np.iinfo(np.uint8).max
-            modal_data[modal_mask,i] = np.iinfo(np.uint8).max
-            node.mesh.is_visible = False
+        return amodal_data, modal_data
 
-        renderer.delete()
-        
-        # Show all meshes
-        for mn in self._scene.mesh_nodes:
-            mn.mesh.is_visible = True
+    def _render_instance_ids(self, obj_mesh_nodes):
+        """ Renders the index of the object visible at each pixel in one pass.
 
-        return amodal_data, modal_data
+        Parameters
+        ----------
+        obj_mesh_nodes : list of :obj:`pyrender.Node`
+            object nodes to label; the node at index i is labeled i+1
+
+        Returns
+        -------
+        :obj:`numpy.ndarray`
+            HxW integer label image, 0 for background and workspace meshes
+        """
+        # workspace meshes still occlude objects, so render them with the background id
+        seg_node_map = {mn: np.zeros(3) for mn in self._scene.mesh_nodes}
+        for i, node in enumerate(obj_mesh_nodes, 1):
+            seg_node_map[node] = np.array([i & 0xFF, (i >> 8) & 0xFF, (i >> 16) & 0xFF])
+
+        seg, _ = self._renderer.render(self._scene, flags=RenderFlags.SEG, seg_node_map=seg_node_map)
+        seg = seg.astype(np.int32)
+        return seg[:,:,0] | (seg[:,:,1] << 8) | (seg[:,:,2] << 16)
 
     def _create_raymond_lights(self):
-        thetas = np.pi * np.array([1.0 / 6.0, 1.0 / 6.0, 1.0 / 6.0])
-        phis = np.pi * np.array([0.0, 2.0 / 3.0, 4.0 / 3.0])
-
-        nodes = []
-
-        for phi, theta in zip(phis, thetas):
-            xp = np.sin(theta) * np.cos(phi)
-            yp = np.sin(theta) * np.sin(phi)
-            zp = np.cos(theta)
-
-            z = np.array([xp, yp, zp])
-            z = z / np.linalg.norm(z)
-            x = np.array([-z[1], z[0], 0.0])
-            if np.linalg.norm(x) == 0:
-                x = np.array([1.0, 0.0, 0.0])
-            x = x / np.linalg.norm(x)
-            y = np.cross(z, x)
-
-            matrix = np.eye(4)
-            matrix[:3,:3] = np.c_[x,y,z]
-            nodes.append(Node(
-                light=DirectionalLight(color=np.ones(3), intensity=1.0),
-                matrix=matrix
-            ))
-
-        return nodes
+        return [Node(light=DirectionalLight(color=np.ones(3), intensity=1.0), matrix=matrix)
+                for matrix in _RAYMOND_MATRICES]
@@ -36,5 +36,8 @@ ENVIRONMENT_KEY = 'environment'
 TRAIN_ID = 0
 TEST_ID = 1
 
+# Rendering
+MESH_CACHE_SIZE = 100
+
 # Physical Constants
 GRAVITY_ACCEL = 9.81
@@ -351,7 +351,7 @@ class HeapStateSpace(gym.Space):
         self._physics_engine.stop()
 
         # add metadata for heap state and return it
-        metadata = {'split': TRAIN_ID}
+        metadata = {'split': TRAIN_ID, 'heap_center': heap_center}
         if not train:
             metadata['split'] = TEST_ID
 
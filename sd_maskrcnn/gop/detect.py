@@ -203,7 +203,7 @@ class MCG(object):
           ids = self.fast_nms(sp2reg, sp, scores, self.nms_thresh)
           sp2reg = sp2reg[ids, :]
         N = sp2reg.shape[0]
-        mask = np.zeros((sp.shape[0], sp.shape[1], N), dtype=np.bool)
+        mask = np.zeros((sp.shape[0], sp.shape[1], N), dtype=np.bool_)
         for i in tqdm(range(N)):
             mask[:,:,i] = sp2reg[i,:][sp-1]
         return mask
@@ -247,7 +247,7 @@ class GOP(object):
 
         # Read out all the masks
         N = b.shape[0]
-        mask = np.zeros((s.s.shape[0], s.s.shape[1], N), dtype=np.bool)
+        mask = np.zeros((s.s.shape[0], s.s.shape[1], N), dtype=np.bool_)
         for i in range(b.shape[0]):
             mask[:,:,i] = b[i,s.s]
         return mask
@@ -69,7 +69,7 @@ def s_benchmark(run_dir, dataset_real, inference_config, pred_mask_dir, pred_inf
         assert(is_sorted)
         overlaps = utilslib.compute_overlaps(r['rois'], gt_bbox)
         dt = {'sc': sc[:,np.newaxis]*1.}
-        gt = {'diff': np.zeros((gt_bbox.shape[0],1), dtype=np.bool)}
+        gt = {'diff': np.zeros((gt_bbox.shape[0],1), dtype=np.bool_)}
 
         for tps, fps, scs, num_insts, dup_dets, inst_ids, ovs, tp_inds, fn_inds, \
             gt_stats, thresh in ms:
@@ -239,15 +239,15 @@ def inst_bench_image(dt, gt, bOpts, overlap=None):
     numInst = np.sum(gt['diff'] == False)
 
     if overlap is None:
-        overlap = bbox_utils.bbox_overlaps(dt['boxInfo'].astype(np.float), gt['boxInfo'].astype(np.float))
+        overlap = bbox_utils.bbox_overlaps(dt['boxInfo'].astype(np.float64), gt['boxInfo'].astype(np.float64))
     
         # assert(issorted(-dt.sc), 'Scores are not sorted.\n');
     sc = dt['sc']
 
-    det    = np.zeros((nGt,1)).astype(np.bool)
-    tp     = np.zeros((nDt,1)).astype(np.bool)
-    fp     = np.zeros((nDt,1)).astype(np.bool)
-    dupDet = np.zeros((nDt,1)).astype(np.bool)
+    det    = np.zeros((nGt,1), dtype=np.bool_)
+    tp     = np.zeros((nDt,1), dtype=np.bool_)
+    fp     = np.zeros((nDt,1), dtype=np.bool_)
+    dupDet = np.zeros((nDt,1), dtype=np.bool_)
     instId = np.zeros((nDt,1)).astype(np.int32)
     ov     = np.zeros((nDt,1)).astype(np.float32)
 
@@ -304,8 +304,8 @@ def inst_bench(dt, gt, bOpts, tp=None, fp=None, score=None, numInst=None):
                 sc = np.vstack((sc[i,:] for i in ind))
                 bb = np.vstack((bb[i,:] for i in ind))
             else:
-                sc = np.zeros((0,1)).astype(np.float)
-                bb = np.zeros((0,4)).astype(np.float)
+                sc = np.zeros((0,1))
+                bb = np.zeros((0,4))
 
         dtI = dict({'boxInfo': bb, 'sc': sc})
         tp_i, fp_i, sc_i, numInst_i, dupDet_i, instId_i, ov_i = inst_bench_image(dtI, gt[i], bOpts)
@@ -35,8 +35,8 @@ requirements = [
 
 generation_requirements = [
     'gym>=0.11',             # For sampling heaps
-    'pyglet==1.4.0b1',       # For pyrender  
-    'pyrender>=0.1.23',      # For rendering images
+    'pyglet>=1.4.10',        # For pyrender
+    'pyrender>=0.1.41',      # For rendering images
     'pybullet',              # For dynamic sim
     'trimesh',               # For mesh loading/exporting
     'scipy'                  # For random vars
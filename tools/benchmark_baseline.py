@@ -164,7 +164,7 @@ def s_benchmark(run_dir, dataset_dir, indices_arr, pred_mask_dir, pred_info_dir,
         assert(is_sorted)
         overlaps = utilslib.compute_overlaps(r['rois'], gt_bbox)
         dt = {'sc': sc[:,np.newaxis]*1.}
-        gt = {'diff': np.zeros((gt_bbox.shape[0],1), dtype=np.bool)}
+        gt = {'diff': np.zeros((gt_bbox.shape[0],1), dtype=np.bool_)}
 
         for tps, fps, scs, num_insts, dup_dets, inst_ids, ovs, tp_inds, fn_inds, \
             gt_stats, thresh in ms:
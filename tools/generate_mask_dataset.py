@@ -76,6 +76,9 @@ def generate_segmask_dataset(output_dataset_path, config, save_tensors=True, war
     states_per_flush = config['states_per_flush']
     states_per_garbage_collect = config['states_per_garbage_collect']
 
+    # prefetching is opt-in and never used in debug mode, to keep runs seeded
+    prefetch_states = 'prefetch_states' in config.keys() and config['prefetch_states'] and not debug
+
     # set max obj per state
     max_objs_per_state = config['state_space']['heap']['max_objs']
 
@@ -303,7 +306,8 @@ def generate_segmask_dataset(output_dataset_path, config, save_tensors=True, war
 
         # sample states
         states_remaining = num_states - state_id
-        for i in range(min(states_per_garbage_collect, states_remaining)):
+        num_env_states = min(states_per_garbage_collect, states_remaining)
+        for i in range(num_env_states):
             
             # log current rollout
             if state_id % config['log_rate'] == 0:
@@ -314,6 +318,10 @@ def generate_segmask_dataset(output_dataset_path, config, save_tensors=True, war
                 env.reset()
                 state = env.state
                 split = state.metadata['split']
+
+                # sample the next state while this one is rendered
+                if prefetch_states and i + 1 < num_env_states:
+                    env.prefetch_state()
                 
                 # render state
                 if vis_config['state']:
@@ -399,9 +407,9 @@ def generate_segmask_dataset(output_dataset_path, config, save_tensors=True, war
                         amodal_segmask_arr[:,:,:env.num_objects] = amodal_segmasks
 
                         if image_config['semantic']:
-                            for j in range(env.num_objects):
-                                this_obj_px = np.where(modal_segmasks[:,:,j] > 0)
-                                stacked_segmask_arr[this_obj_px[0], this_obj_px[1],0] = j+1
+                            # modal masks are disjoint, so this labels each pixel with its object index + 1
+                            obj_labels = np.arange(1, env.num_objects + 1)
+                            stacked_segmask_arr[:,:,0] = (modal_segmasks > 0).dot(obj_labels)
 
                     # visualize
                     if vis_config['semantic']:
@@ -481,6 +489,7 @@ def generate_segmask_dataset(output_dataset_path, config, save_tensors=True, war
                 if debug:
                     raise
                 
+                env.close()
                 del env
                 gc.collect()
                 env = BinHeapEnv(config)
@@ -490,6 +499,7 @@ def generate_segmask_dataset(output_dataset_path, config, save_tensors=True, war
                 env.state_space.mesh_filenames = mesh_filenames
                 
         # garbage collect
+        env.close()
         del env
         gc.collect()
         